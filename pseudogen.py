@@ -1,15 +1,38 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import argparse
+import ast
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import mmap
 import os
+import re
+import stat
 import sys
+import tempfile
+import time
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
-import requests
-import tiktoken
 import logging
-from typing import List
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+# Heavy dependencies are imported where they are first used, so paths that never
+# tokenize or call the API (--list-models, fully cached runs) skip loading them
+if TYPE_CHECKING:
+    import aiohttp
+    import faiss
+    import tiktoken
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
 
 # Set up logging configuration
 def setup_logging(level: str) -> None:
@@ -36,6 +59,68 @@ AVAILABLE_MODELS = {
 
 MAX_TOKENS = 4096  # Define a reasonable token threshold
 
+# Context window of each model, used to size chunks
+CONTEXT_LIMITS = {
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4o": 128000,
+    "o1-mini": 128000,
+    "o1-preview": 128000
+}
+# Most tokens each model will generate in one response, sent as max_tokens. gpt-4 and gpt-4-32k
+# have no separate cap and share their context with the prompt, so half of it goes to the response
+OUTPUT_LIMITS = {
+    "gpt-3.5-turbo-1106": 4096,
+    "gpt-4-1106-preview": 4096,
+    "gpt-4": 4096,
+    "gpt-4-32k": 16384,
+    "gpt-4o": 16384,
+    "o1-mini": 65536,
+    "o1-preview": 32768
+}
+PROMPT_OVERHEAD_TOKENS = 16  # Chat message framing not counted by tiktoken
+DEFAULT_CONCURRENCY = 8  # Maximum number of in-flight API requests
+DEFAULT_SEED = 42  # Sampling seed, part of every cache key
+HTTP_MAX_CONNECTIONS = 32  # Connection pool size for the OpenAI client
+HTTP_TIMEOUT = 60  # Seconds
+MMAP_THRESHOLD = 4 * 1024 * 1024  # Source files larger than this are memory-mapped
+READ_BLOCK_SIZE = 64 * 1024  # Read size for pipes and other files without a known size
+
+# Batch prompting: several chunks are sent in one request and split on these sentinels
+BATCH_INSTRUCTIONS = (
+    "The code below consists of {count} independent blocks. Handle each block separately and "
+    "return the results in order, each starting on its own line with '=== BLOCK i ===' "
+    "where i is the block number.\n\n"
+)
+BATCH_SENTINEL = re.compile(r"^=== BLOCK (\d+) ===[ \t]*$", re.MULTILINE)
+BATCH_LABEL_TOKENS = 8  # Tokens used by each "Block i:" label
+
+# Transient API errors are retried; chunks that still fail are replaced by a placeholder
+RETRY_ATTEMPTS = 6
+FAILED_CHUNK_PLACEHOLDER = "[[CHUNK {index} FAILED]]"
+
+# With --skip-trivial, sources below this size (or with no real code) are not sent to the model
+TRIVIAL_TOKENS = 20
+TRIVIAL_MAX_CHARS = 1024  # No realistic source this long is under TRIVIAL_TOKENS
+TRIVIAL_PSEUDOCODE = "# (trivial module - no pseudocode needed)"
+
+# On-disk response cache, sharded by the first two hex digits of the key
+_cache_path = Path(os.getenv("PSEUDOGEN_CACHE", "~/.pseudogen/cache")).expanduser()
+
+# Semantic cache: chunk embeddings used to reuse responses for near-duplicate code
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+EMBEDDING_MAX_TOKENS = 8191  # Longest input the embedding model accepts
+DEFAULT_SEMANTIC_THRESHOLD = 0.97
+HNSW_NEIGHBORS = 32  # Graph degree of the FAISS HNSW index
+
+# FAISS indexes and their cache keys, loaded lazily and kept for the rest of the run;
+# indexes with new entries are written back once by semantic_cache_save
+_semantic_indexes = {}
+_semantic_dirty = set()
+
 
 ABSTRACTION_LEVELS = {
     0: {
@@ -136,102 +221,753 @@ ABSTRACTION_LEVELS = {
     }
 }
 
+# Line boundaries as counted by ast: after \n, and after \r unless it starts a \r\n
+LINE_BREAK = re.compile(r"(?<=\n)|(?<=\r)(?!\n)")
+
+# User message templates split once around the chunk placeholder
+USER_MESSAGE_PARTS = {
+    level: tuple(messages["user_message"].split("{chunk}", 1))
+    for level, messages in ABSTRACTION_LEVELS.items()
+}
+
+
+def _decode_source(data) -> str:
+    """Decode UTF-8 source and translate newlines the way text-mode open() does."""
+    text = str(data, 'utf-8')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
 
 
-def read_source_file(file_path: str) -> str:
+def read_file_sync(file_path: str) -> str:
+    """Read and decode a UTF-8 file with a single pre-sized buffer."""
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        size = st.st_size
+        if not stat.S_ISREG(st.st_mode) or size == 0:
+            # Pipes, process substitution and procfs files report no usable size; read until EOF
+            parts = []
+            while True:
+                data = os.read(fd, READ_BLOCK_SIZE)
+                if not data:
+                    break
+                parts.append(data)
+            return _decode_source(b"".join(parts))
+        if size > MMAP_THRESHOLD:
+            # Decode straight from the page cache instead of copying into a buffer first
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+                return _decode_source(mapped)
+        buf = bytearray(size)
+        view = memoryview(buf)
+        read = 0
+        while read < size:
+            n = os.readv(fd, [view[read:]])
+            if n == 0:
+                break
+            read += n
+        return _decode_source(view[:read])
+    finally:
+        os.close(fd)
+
+
+async def read_source_file(file_path: str) -> str:
     """Read the contents of the source file."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        # Disk reads block, so keep them off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, read_file_sync, file_path)
     except Exception as e:
-        logging.error(f"Error reading file {file_path}: {e}")
+        logger.error("Error reading file %s: %s", file_path, e)
         sys.exit(1)
 
 
-def count_tokens(text: str, model: str = "gpt-3.5-turbo-1106") -> int:
-    """Count the number of tokens in the text for a given model."""
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str) -> tiktoken.Encoding:
+    """Return the (memoized) tiktoken encoding for a model."""
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
+def encode_text(text: str, model: str = "gpt-3.5-turbo-1106") -> List[int]:
+    """Encode text into tokens for a given model."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
-        tokens = encoding.encode(text)
-        return len(tokens)
+        return _encoding(model).encode(text)
     except Exception as e:
-        logging.error(f"Error counting tokens: {e}")
+        logger.error("Error counting tokens: %s", e)
         sys.exit(1)
 
 
+def count_tokens(text: str, model: str = "gpt-3.5-turbo-1106") -> int:
+    """Count the number of tokens in the text for a given model."""
+    return len(encode_text(text, model))
+
+
+def split_tokens(tokens: List[int], model: str = "gpt-3.5-turbo-1106", budget: int = MAX_TOKENS) -> List[str]:
+    """Split already-encoded source code into text chunks of at most budget tokens."""
+    encoding = _encoding(model)
+    windows = [tokens[i:i + budget] for i in range(0, len(tokens), budget)]
+    # Decode all windows in a single call rather than one call per chunk
+    if hasattr(encoding, 'decode_batch'):
+        return encoding.decode_batch(windows)
+    # Older tiktoken releases lack decode_batch; decode releases the GIL, so use threads
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return list(executor.map(encoding.decode, windows))
+
+
 def split_source_code(source_code: str, model: str = "gpt-3.5-turbo-1106") -> List[str]:
     """Split source code into chunks that fit within the token limit."""
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(source_code)
-    
-    # Split tokens into chunks
-    chunks = []
-    for i in range(0, len(tokens), MAX_TOKENS):
-        chunk_tokens = tokens[i:i + MAX_TOKENS]
-        chunk_text = encoding.decode(chunk_tokens)
-        chunks.append(chunk_text)
-    
-    return chunks
+    return split_tokens(encode_text(source_code, model), model)
 
 
-def generate_pseudocode(source_code: str, api_key: str, model: str = "gpt-3.5-turbo-1106", abstract_level: int = 1) -> str:
-    """Generate pseudocode using OpenAI's GPT model."""
-    if not api_key:
-        logging.error("OpenAI API key not found. Please set it in .env file.")
-        sys.exit(1)
+def cache_key(model: str, abstract_level: int, system_message: str, user_message: str,
+              seed: int = DEFAULT_SEED) -> str:
+    """Build the content-addressed cache key for a single completion request."""
+    payload = json.dumps([model, abstract_level, seed, system_message, user_message], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def source_cache_key(source_code: str, model: str, abstract_level: int, seed: int = DEFAULT_SEED) -> str:
+    """Build the cache key for the combined pseudocode of a whole source.
+
+    The source is hashed on its own after the (self-delimiting) JSON header instead of being
+    embedded in the prompt and JSON-encoded, which would copy a large source several times.
+    """
+    system_message, user_template = build_messages("", abstract_level)
+    header = json.dumps(["source", model, abstract_level, seed, system_message, user_template], sort_keys=True)
+    digest = hashlib.sha256(header.encode('utf-8'))
+    digest.update(source_code.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cache_get(key: str, ttl: Optional[int] = None) -> Optional[str]:
+    """Return the cached response for key, or None on a miss or expired entry."""
+    path = _cache_path / key[:2] / key
+    try:
+        if ttl is not None and time.time() - path.stat().st_mtime > ttl:
+            return None
+        return path.read_text(encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Error reading cache entry %s: %s", key, e)
+        return None
+
+
+def cache_put(key: str, value: str) -> None:
+    """Atomically store a response in the cache; failures are logged, not fatal."""
+    shard = _cache_path / key[:2]
+    try:
+        shard.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=shard, delete=False) as tmp:
+            tmp.write(value)
+        os.replace(tmp.name, shard / key)
+    except OSError as e:
+        logger.warning("Error writing cache entry %s: %s", key, e)
+
 
+async def embed_chunks(client: AsyncOpenAI, chunks: List[str]) -> list:
+    """Return the L2-normalized float32 embedding of each code chunk, using one request.
+
+    Chunks longer than the embedding model accepts get None. Truncating them instead would make
+    large chunks that merely share a prefix look identical, so they skip the semantic cache.
+    """
+    import numpy as np
+
+    tokens = [encode_text(chunk, EMBEDDING_MODEL) for chunk in chunks]
+    fits = [i for i, chunk_tokens in enumerate(tokens) if len(chunk_tokens) <= EMBEDDING_MAX_TOKENS]
+    vecs = [None] * len(chunks)
+    if not fits:
+        return vecs
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=[tokens[i] for i in fits])
+    for i, item in zip(fits, sorted(response.data, key=lambda item: item.index)):
+        vec = np.asarray(item.embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        vecs[i] = vec / norm if norm else vec
+    return vecs
+
+
+def _semantic_index(model: str, abstract_level: int) -> Tuple[Path, "faiss.Index", List[str]]:
+    """Return the index file, FAISS index and cache keys for a model and level, loading them on first use.
+
+    The index and its key list are stored together in one .npz file, so they are always replaced as a pair.
+    """
+    import faiss
+    import numpy as np
+
+    # Responses are only interchangeable within one model and abstraction level, so each gets its own index
+    name = hashlib.sha256(json.dumps([model, abstract_level]).encode('utf-8')).hexdigest()[:16]
+    index_file = _cache_path / "semantic" / f"{name}.npz"
+    if index_file not in _semantic_indexes:
+        if index_file.exists():
+            with np.load(index_file) as data:
+                index = faiss.deserialize_index(data["index"])
+                keys = json.loads(data["keys"].tobytes().decode('utf-8'))
+        else:
+            index = faiss.IndexHNSWFlat(EMBEDDING_DIM, HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+            keys = []
+        _semantic_indexes[index_file] = (index, keys)
+    return (index_file,) + _semantic_indexes[index_file]
+
+
+def semantic_cache_get(vec, model: str, abstract_level: int, threshold: float,
+                       ttl: Optional[int] = None) -> Optional[str]:
+    """Return the cached response whose chunk embedding is most similar to vec, if above threshold."""
+    try:
+        _, index, keys = _semantic_index(model, abstract_level)
+    except (OSError, RuntimeError, ValueError, KeyError) as e:
+        logger.warning("Error loading semantic cache: %s", e)
+        return None
+
+    if index.ntotal == 0:
+        return None
+    similarities, ids = index.search(vec.reshape(1, -1), 1)
+    best, similarity = int(ids[0, 0]), float(similarities[0, 0])
+    # HNSW returns -1 when it finds no neighbour
+    if not 0 <= best < len(keys) or similarity <= threshold:
+        return None
+    logger.info("Semantic cache hit (similarity %.4f)", similarity)
+    return cache_get(keys[best], ttl)
+
+
+def semantic_cache_put(vec, key: str, model: str, abstract_level: int) -> None:
+    """Add an embedding and its response key to the in-memory semantic cache index."""
+    try:
+        index_file, index, keys = _semantic_index(model, abstract_level)
+    except (OSError, RuntimeError, ValueError, KeyError) as e:
+        logger.warning("Error loading semantic cache: %s", e)
+        return
+    index.add(vec.reshape(1, -1))
+    keys.append(key)
+    _semantic_dirty.add(index_file)
+
+
+def semantic_cache_save() -> None:
+    """Write every semantic cache index that gained entries during this run back to disk.
+
+    Each index is written with its keys to a temporary file and swapped in with one os.replace, so
+    overlapping runs can lose each other's additions but never pair one run's index with another's keys.
+    """
+    import faiss
+    import numpy as np
+
+    while _semantic_dirty:
+        index_file = _semantic_dirty.pop()
+        index, keys = _semantic_indexes[index_file]
+        try:
+            index_file.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=index_file.parent, delete=False) as tmp:
+                np.savez(tmp, index=faiss.serialize_index(index),
+                         keys=np.frombuffer(json.dumps(keys).encode('utf-8'), dtype=np.uint8))
+            os.replace(tmp.name, index_file)
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.warning("Error writing semantic cache: %s", e)
+
+
+def validate_model(model: str) -> None:
+    """Exit with a list of available models if model is not supported."""
     if model not in AVAILABLE_MODELS:
-        logging.error(f"Invalid model '{model}'. Available models:")
+        logger.error("Invalid model '%s'. Available models:", model)
         for m, desc in AVAILABLE_MODELS.items():
-            logging.error(f"  - {m}: {desc}")
+            logger.error("  - %s: %s", m, desc)
         sys.exit(1)
 
-    # Count tokens
-    token_count = count_tokens(source_code, model)
-    logging.info(f"Token count for the input: {token_count}")
 
-    # Split source code if it exceeds the token limit
-    if token_count > MAX_TOKENS:
-        logging.info("Source code exceeds token limit, splitting into chunks...")
-        source_chunks = split_source_code(source_code, model)
+def build_messages(chunk: str, abstract_level: int) -> Tuple[str, str]:
+    """Return the system and user messages for a chunk at the given abstraction level."""
+    if abstract_level in ABSTRACTION_LEVELS:
+        system_message = ABSTRACTION_LEVELS[abstract_level]["system_message"]
+        prefix, suffix = USER_MESSAGE_PARTS[abstract_level]
+        user_message = prefix + chunk + suffix
     else:
-        source_chunks = [source_code]
+        system_message = (
+            "You are a helpful assistant that converts source code into clear, "
+            "readable pseudocode. Your pseudocode should be language-agnostic "
+            "and as concise as possible."
+        )
+        user_message = (
+            f"Convert the following code into pseudocode. Use clear, concise "
+            f"language and maintain the logical structure:\n\n{chunk}"
+        )
+    return system_message, user_message
 
-    client = OpenAI(api_key=api_key)
-    pseudocode_chunks = []
 
-    for i, chunk in enumerate(source_chunks):
-        logging.info(f"Processing chunk {i + 1} of {len(source_chunks)}")
-        try:
-            if abstract_level in ABSTRACTION_LEVELS:
-                system_message = ABSTRACTION_LEVELS[abstract_level]["system_message"]
-                user_message = ABSTRACTION_LEVELS[abstract_level]["user_message"].format(chunk=chunk)
-            else:
-                system_message = (
-                    "You are a helpful assistant that converts source code into clear, "
-                    "readable pseudocode. Your pseudocode should be language-agnostic "
-                    "and as concise as possible."
-                )
-                user_message = (
-                    f"Convert the following code into pseudocode. Use clear, concise "
-                    f"language and maintain the logical structure:\n\n{chunk}"
-                )
-
-            response = client.chat.completions.create(
+def retryable_errors() -> Tuple[type, ...]:
+    """Return the transient OpenAI errors that are retried and, once retries run out, tolerated.
+
+    openai-python does not wrap errors raised while iterating a stream, so a connection dropped
+    mid-response surfaces as a raw httpx transport error.
+    """
+    import httpx
+    import openai
+
+    return (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError, httpx.TransportError)
+
+
+class TruncatedResponseError(Exception):
+    """Raised when a response was cut off by its max_tokens limit."""
+
+
+async def request_completion(client: AsyncOpenAI, model: str, system_message: str, user_message: str,
+                             seed: int = DEFAULT_SEED) -> str:
+    """Send a single streaming chat completion request and return the assembled response text.
+
+    Sampling is greedy with a fixed seed so identical prompts give (best-effort) identical
+    responses. Rate limits, connection errors and server errors are retried with exponential
+    backoff. The response may use the model's whole output limit; TruncatedResponseError is
+    raised if it hit that limit, so that partial pseudocode is never returned or cached.
+    """
+    import tenacity
+
+    limit = {}
+    # o1 models reject max_tokens, and their hidden reasoning counts against any output limit
+    if not model.startswith("o1"):
+        limit["max_tokens"] = OUTPUT_LIMITS.get(model, MAX_TOKENS)
+
+    retrying = tenacity.AsyncRetrying(
+        retry=tenacity.retry_if_exception_type(retryable_errors()),
+        wait=tenacity.wait_exponential_jitter(initial=1, max=30),
+        stop=tenacity.stop_after_attempt(RETRY_ATTEMPTS),
+        before_sleep=lambda state: logger.warning(
+            "Request failed (%s), retrying (attempt %d)", state.outcome.exception(), state.attempt_number
+        ),
+        reraise=True
+    )
+    async for attempt in retrying:
+        with attempt:
+            stream = await client.chat.completions.create(
                 model=model,
                 messages=[
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": user_message}
                 ],
-                temperature=0.1
+                temperature=0,
+                top_p=1,
+                seed=seed,
+                stream=True,
+                **limit
             )
-            pseudocode_chunks.append(response.choices[0].message.content)
-        except Exception as e:
-            logging.error(f"Error generating pseudocode: {e}")
-            sys.exit(1)
+            parts = []
+            finish_reason = None
+            async for event in stream:
+                if event.choices:
+                    if event.choices[0].delta.content:
+                        parts.append(event.choices[0].delta.content)
+                    finish_reason = event.choices[0].finish_reason or finish_reason
+            if finish_reason == "length":
+                raise TruncatedResponseError("response was cut off at the output token limit")
+            return "".join(parts)
+
+
+async def process_chunk(client: AsyncOpenAI, sem: asyncio.Semaphore, chunk: str, model: str,
+                        abstract_level: int, use_cache: bool = True, cache_ttl: Optional[int] = None,
+                        semantic_threshold: Optional[float] = None, seed: int = DEFAULT_SEED) -> str:
+    """Generate pseudocode for a single chunk, consulting the caches first.
+
+    If the response is cut off at the output limit, the chunk is split in half and each piece
+    is generated separately, repeatedly if needed.
+    """
+    system_message, user_message = build_messages(chunk, abstract_level)
+
+    key = cache_key(model, abstract_level, system_message, user_message, seed)
+    if use_cache:
+        cached = cache_get(key, cache_ttl)
+        if cached is not None:
+            logger.info("Cache hit for chunk")
+            return cached
+
+    async with sem:
+        vec = None
+        if use_cache and semantic_threshold is not None:
+            vec = (await embed_chunks(client, [chunk]))[0]
+            if vec is not None:
+                cached = semantic_cache_get(vec, model, abstract_level, semantic_threshold, cache_ttl)
+                if cached is not None:
+                    return cached
+
+        try:
+            content = await request_completion(client, model, system_message, user_message, seed)
+        except TruncatedResponseError:
+            tokens = count_tokens(chunk, model)
+            if tokens < 2:
+                raise
+            content = None
+    if content is None:
+        pieces = chunk_source(chunk, model, tokens // 2)
+        logger.warning("Response for a %d-token chunk was truncated, retrying it as %d pieces", tokens, len(pieces))
+        content = "\n\n".join(await asyncio.gather(*(
+            process_chunk(client, sem, piece, model, abstract_level, use_cache, cache_ttl, semantic_threshold, seed)
+            for piece in pieces
+        )))
+    if use_cache:
+        cache_put(key, content)
+        if vec is not None:
+            semantic_cache_put(vec, key, model, abstract_level)
+    return content
+
+
+def create_client(api_key: str, concurrency: int = DEFAULT_CONCURRENCY) -> AsyncOpenAI:
+    """Create an OpenAI client whose HTTP/2 connection pool is shared by all requests in a run."""
+    import httpx
+    from openai import AsyncOpenAI
+
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=max(concurrency, HTTP_MAX_CONNECTIONS),
+                            max_keepalive_connections=max(concurrency, HTTP_MAX_CONNECTIONS))
+    )
+    # Retries are handled by request_completion
+    return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+
+def pack_chunks(chunks: List[str], model: str, batch_size: int, budget: int = MAX_TOKENS,
+                block_tokens: int = 0) -> List[List[int]]:
+    """Greedily group consecutive chunk indices into batches of at most batch_size chunks and budget tokens.
+
+    Each chunk costs its own tokens plus block_tokens (its label).
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, chunk in enumerate(chunks):
+        tokens = count_tokens(chunk, model) + block_tokens
+        if current and (len(current) == batch_size or current_tokens + tokens > budget):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_batch_response(content: str, count: int) -> Optional[List[str]]:
+    """Split a batched response on its block sentinels; return None if it is malformed."""
+    parts = BATCH_SENTINEL.split(content)
+    # re.split yields [preamble, "1", body1, "2", body2, ...]
+    numbers = [int(n) for n in parts[1::2]]
+    if numbers != list(range(1, count + 1)):
+        return None
+    return [body.strip() for body in parts[2::2]]
+
+
+async def process_batch(client: AsyncOpenAI, sem: asyncio.Semaphore, chunks: List[str], model: str,
+                        abstract_level: int, **options) -> List[str]:
+    """Generate pseudocode for several chunks with one request, falling back to per-chunk requests.
+
+    With a semantic threshold, each chunk is first looked up in the semantic cache and only the
+    misses are sent in the batch.
+    """
+    use_cache = options.get("use_cache", True)
+    semantic_threshold = options.get("semantic_threshold")
+    seed = options.get("seed", DEFAULT_SEED)
+    results: List[Optional[str]] = [None] * len(chunks)
+    vecs = [None] * len(chunks)
+    async with sem:
+        if use_cache and semantic_threshold is not None:
+            vecs = await embed_chunks(client, chunks)
+            results = [semantic_cache_get(vec, model, abstract_level, semantic_threshold, options.get("cache_ttl"))
+                       if vec is not None else None for vec in vecs]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+
+        blocks = "\n\n".join(f"Block {n}:\n{chunks[i]}" for n, i in enumerate(misses, 1))
+        system_message, user_message = build_messages(blocks, abstract_level)
+        user_message = BATCH_INSTRUCTIONS.format(count=len(misses)) + user_message
+        try:
+            content = await request_completion(client, model, system_message, user_message, seed)
+        except TruncatedResponseError:
+            content = ""
+    outputs = parse_batch_response(content, len(misses))
+    if outputs is None:
+        logger.warning("Could not parse batched response for %d chunks, retrying individually", len(misses))
+        outputs = await asyncio.gather(*(
+            process_chunk(client, sem, chunks[i], model, abstract_level, **options) for i in misses
+        ))
+    elif use_cache:
+        # Store each block under its single-chunk key so later runs hit regardless of batching
+        for i, output in zip(misses, outputs):
+            key = cache_key(model, abstract_level, *build_messages(chunks[i], abstract_level), seed)
+            cache_put(key, output)
+            if vecs[i] is not None:
+                semantic_cache_put(vecs[i], key, model, abstract_level)
+
+    for i, output in zip(misses, outputs):
+        results[i] = output
+    return results
+
+
+def ast_chunks(source_code: str, model: str = "gpt-3.5-turbo-1106", budget: int = MAX_TOKENS) -> Optional[List[str]]:
+    """Split Python source at top-level statement boundaries into chunks of at most budget tokens.
+
+    Returns None if the source is not valid Python.
+    """
+    try:
+        tree = ast.parse(source_code)
+    except (SyntaxError, ValueError):
+        return None
+    if not tree.body:
+        return None
+
+    # Each top-level statement (with its decorators and any preceding comments) is one segment
+    # Split only on the line breaks ast counts; str.splitlines also breaks on \f, \u2028 etc.
+    lines = [line for line in LINE_BREAK.split(source_code) if line]
+    starts = [min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])]) - 1
+              for node in tree.body]
+    starts[0] = 0
+    segments = []
+    for position, (start, end) in enumerate(zip(starts, starts[1:] + [len(lines)])):
+        text = "".join(lines[start:end])
+        tokens = encode_text(text, model)
+        if len(tokens) > budget:
+            # A single statement too large for one chunk is split on token windows
+            for offset, piece in enumerate(split_tokens(tokens, model, budget)):
+                segments.append((position, offset, piece, count_tokens(piece, model)))
+        else:
+            segments.append((position, 0, text, len(tokens)))
+
+    # First-fit decreasing bin packing
+    bins = []
+    for segment in sorted(segments, key=lambda seg: seg[3], reverse=True):
+        for packed in bins:
+            if packed["tokens"] + segment[3] <= budget:
+                packed["segments"].append(segment)
+                packed["tokens"] += segment[3]
+                break
+        else:
+            bins.append({"segments": [segment], "tokens": segment[3]})
+
+    # Keep source order within each chunk and across chunks
+    ordered = sorted((sorted(packed["segments"]) for packed in bins), key=lambda segs: segs[0][:2])
+    return ["".join(seg[2] for seg in segs) for segs in ordered]
+
+
+def _is_stub(node: ast.AST) -> bool:
+    """Return True if a statement carries no logic worth describing."""
+    if isinstance(node, (ast.Import, ast.ImportFrom, ast.Pass)):
+        return True
+    if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+        return True  # Docstrings and bare ...
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return all(_is_stub(child) for child in node.body)
+    return False
+
+
+def is_trivial(source_code: str, model: str = "gpt-3.5-turbo-1106") -> bool:
+    """Return True for sources not worth sending to the model.
+
+    That is empty input, Python containing only imports, docstrings and classes or functions
+    whose bodies are just docstrings and pass (e.g. package __init__ files and unimplemented
+    stubs), or anything shorter than TRIVIAL_TOKENS tokens.
+    """
+    if not source_code.strip():
+        return True
+    try:
+        tree = ast.parse(source_code)
+    except (SyntaxError, ValueError):
+        tree = None
+    if tree is not None and all(_is_stub(node) for node in tree.body):
+        return True
+    # Only tokenize inputs short enough to possibly be under the threshold
+    return len(source_code) <= TRIVIAL_MAX_CHARS and count_tokens(source_code, model) < TRIVIAL_TOKENS
+
+
+@functools.lru_cache(maxsize=None)
+def chunk_budget(model: str, abstract_level: int) -> int:
+    """Return the number of source tokens that fit in one request for a model and abstraction level.
+
+    The chunk, the prompt and a full-length response must fit in the context window. Pseudocode is
+    about as long as the code it describes, so chunks are also kept within the output limit.
+    """
+    if model not in CONTEXT_LIMITS:
+        return MAX_TOKENS
+    # The prompt is the system message plus the user template around the chunk
+    system_message, user_message = build_messages("", abstract_level)
+    prompt_tokens = count_tokens(system_message, model) + count_tokens(user_message, model) + PROMPT_OVERHEAD_TOKENS
+    output_tokens = OUTPUT_LIMITS[model]
+    return min(CONTEXT_LIMITS[model] - output_tokens - prompt_tokens, output_tokens)
+
+
+def chunk_source(source_code: str, model: str, budget: int = MAX_TOKENS) -> List[str]:
+    """Split a source into chunks of at most budget tokens."""
+    # Encode once and reuse the tokens for splitting
+    tokens = encode_text(source_code, model)
+    logger.info("Token count for the input: %d", len(tokens))
+
+    # Split source code if it exceeds the token limit
+    if len(tokens) > budget:
+        logger.info("Source code exceeds token limit, splitting into chunks...")
+        chunks = ast_chunks(source_code, model, budget)
+        if chunks is not None:
+            return chunks
+        return split_tokens(tokens, model, budget)
+    return [source_code]
+
+
+async def generate_all(source_codes: List[str], api_key: str, model: str = "gpt-3.5-turbo-1106",
+                       abstract_level: int = 1, concurrency: int = DEFAULT_CONCURRENCY,
+                       batch_size: int = 1, emit: Optional[Callable[[str], None]] = None,
+                       skip_trivial: bool = False, **options) -> Tuple[List[str], int]:
+    """Generate pseudocode for several sources concurrently, sharing one client and request limit.
+
+    Returns the pseudocode for each source and the number of chunks that still failed with a
+    transient API error after retrying, or whose response was truncated; those chunks hold a
+    placeholder. Any other error exits.
+
+    If emit is given, each chunk's pseudocode is passed to it as soon as it and every
+    earlier chunk are complete, so output is produced in order while later chunks are
+    still being generated. With skip_trivial, sources that is_trivial accepts get a stub
+    instead of an API call.
+    """
+    use_cache = options.get("use_cache", True)
+    cache_ttl = options.get("cache_ttl")
+    seed = options.get("seed", DEFAULT_SEED)
+    source_chunks: List[List[str]] = []
+    results: List[Optional[str]] = []
+    misses = []
+    source_hits = [cache_get(source_cache_key(source_code, model, abstract_level, seed), cache_ttl)
+                   if use_cache else None for source_code in source_codes]
+
+    def split_sources() -> None:
+        for n, (source_code, cached) in enumerate(zip(source_codes, source_hits)):
+            if cached is not None:
+                # Whole-source hit: skip tokenizing and splitting entirely
+                logger.info("Cache hit for source")
+                source_chunks.append([source_code])
+                results.append(cached)
+                continue
+            if skip_trivial and is_trivial(source_code, model):
+                logger.info("Skipping trivial source %d", n + 1)
+                source_chunks.append([source_code])
+                results.append(TRIVIAL_PSEUDOCODE)
+                continue
+            misses.append(n)
+            per_source = chunk_source(source_code, model, chunk_budget(model, abstract_level))
+            source_chunks.append(per_source)
+            for chunk in per_source:
+                results.append(cache_get(cache_key(model, abstract_level, *build_messages(chunk, abstract_level), seed),
+                                         cache_ttl) if use_cache else None)
+
+    failed = set()
+    async with contextlib.AsyncExitStack() as stack:
+        warmup = None
+        if any(cached is None for cached in source_hits):
+            # Open the pooled connection (DNS, TCP, TLS, HTTP/2) while the sources are tokenized below
+            client = await stack.enter_async_context(create_client(api_key, concurrency))
+            warmup = asyncio.ensure_future(warm_connection(client))
+        # Tokenizing and splitting run in a thread so the event loop can drive the warm-up meanwhile
+        await asyncio.get_running_loop().run_in_executor(None, split_sources)
+
+        chunks = [chunk for per_source in source_chunks for chunk in per_source]
+        # Placeholders number chunks within their own source
+        chunk_numbers = [number for per_source in source_chunks for number in range(1, len(per_source) + 1)]
+        # Identical chunks (shared headers, repeated helpers) are requested once and fanned out
+        positions = collections.defaultdict(list)
+        for i, result in enumerate(results):
+            if result is None:
+                positions[chunks[i]].append(i)
+        pending = [indices[0] for indices in positions.values()]
+        logger.info("Processing %d of %d chunk(s)", len(pending), len(chunks))
+
+        emitted = 0
 
-    logging.info("Pseudocode generation completed.")
-    return "\n\n".join(pseudocode_chunks)
+        def emit_ready() -> None:
+            nonlocal emitted
+            while emit is not None and emitted < len(results) and results[emitted] is not None:
+                emit(("\n\n" if emitted else "") + results[emitted])
+                emitted += 1
+
+        emit_ready()
+
+        if warmup is not None:
+            if not pending:
+                warmup.cancel()
+            await asyncio.gather(warmup, return_exceptions=True)
+
+        if pending:
+            sem = asyncio.Semaphore(concurrency)
+
+            async def run(indices: List[int]) -> None:
+                try:
+                    if len(indices) == 1:
+                        outputs = [await process_chunk(client, sem, chunks[indices[0]], model, abstract_level,
+                                                       **options)]
+                    else:
+                        outputs = await process_batch(client, sem, [chunks[i] for i in indices],
+                                                      model, abstract_level, **options)
+                except retryable_errors() + (TruncatedResponseError,) as e:
+                    # Retries are exhausted or the response was cut off; keep going so the other chunks'
+                    # output (and cache entries) are not lost
+                    logger.error("Error generating pseudocode: %s", e)
+                    for j in (j for i in indices for j in positions[chunks[i]]):
+                        failed.add(j)
+                        results[j] = FAILED_CHUNK_PLACEHOLDER.format(index=chunk_numbers[j])
+                else:
+                    for i, output in zip(indices, outputs):
+                        for j in positions[chunks[i]]:
+                            results[j] = output
+                emit_ready()
+
+            if batch_size == 1:
+                batches = [[j] for j in range(len(pending))]
+            else:
+                # A batch is sized like one chunk: chunk_budget leaves room for a response as long as
+                # the chunk, so each block's share of the output grows with the block itself
+                batch_budget = chunk_budget(model, abstract_level) - count_tokens(BATCH_INSTRUCTIONS, model)
+                batches = pack_chunks([chunks[i] for i in pending], model, batch_size, batch_budget,
+                                      BATCH_LABEL_TOKENS)
+            try:
+                await asyncio.gather(*(run([pending[j] for j in batch]) for batch in batches))
+            except Exception as e:
+                logger.error("Error generating pseudocode: %s", e)
+                sys.exit(1)
+
+    if _semantic_dirty:
+        semantic_cache_save()
+    if failed:
+        logger.warning("Pseudocode generation completed with %d failed chunk(s).", len(failed))
+    else:
+        logger.info("Pseudocode generation completed.")
+    pseudocodes, ranges, start = [], [], 0
+    for per_source in source_chunks:
+        pseudocodes.append("\n\n".join(results[start:start + len(per_source)]))
+        ranges.append(range(start, start + len(per_source)))
+        start += len(per_source)
+    if use_cache:
+        for n in misses:
+            if failed.isdisjoint(ranges[n]):
+                cache_put(source_cache_key(source_codes[n], model, abstract_level, seed), pseudocodes[n])
+    return pseudocodes, len(failed)
+
+
+def generate_pseudocode(source_code: str, api_key: str, model: str = "gpt-3.5-turbo-1106", abstract_level: int = 1,
+                        use_cache: bool = True, cache_ttl: Optional[int] = None,
+                        semantic_threshold: Optional[float] = None,
+                        concurrency: int = DEFAULT_CONCURRENCY, batch_size: int = 1,
+                        seed: int = DEFAULT_SEED) -> str:
+    """Generate pseudocode using OpenAI's GPT model."""
+    if not api_key:
+        logger.error("OpenAI API key not found. Please set it in .env file.")
+        sys.exit(1)
+
+    validate_model(model)
+
+    pseudocodes, failed = asyncio.run(generate_all(
+        [source_code], api_key, model, abstract_level, concurrency, batch_size,
+        use_cache=use_cache, cache_ttl=cache_ttl, semantic_threshold=semantic_threshold, seed=seed
+    ))
+    if failed:
+        sys.exit(1)
+    return pseudocodes[0]
+
+
+async def warm_connection(client: AsyncOpenAI) -> None:
+    """Open a connection in the client's pool with a cheap request, so the first completion reuses it."""
+    try:
+        await client.models.list()
+    except Exception as e:
+        logger.debug("Connection warm-up failed: %s", e)  # The real requests will report any problem
 
 
 def list_available_models() -> None:
@@ -241,25 +977,57 @@ def list_available_models() -> None:
         print(f"  - {model}: {description}")
 
 
-def fetch_source_from_url(url: str) -> str:
+async def fetch_source_from_url(url: str, session: aiohttp.ClientSession) -> str:
     """Fetch the contents of the source file from a URL."""
-    logging.info(f"Fetching source code from URL: {url}")
+    import aiohttp
+
+    logger.info("Fetching source code from URL: %s", url)
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.text
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching file from URL: {e}")
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError) as e:
+        # Timeouts carry no message, so fall back to the exception name
+        logger.error("Error fetching file from URL: %s", str(e) or type(e).__name__)
         sys.exit(1)
 
 
+async def load_sources(source_files: List[str]) -> List[str]:
+    """Read all local files and URLs concurrently, preserving their order."""
+    def is_url(source_file: str) -> bool:
+        return source_file.startswith('http://') or source_file.startswith('https://')
+
+    if not any(is_url(source_file) for source_file in source_files):
+        return await asyncio.gather(*(read_source_file(source_file) for source_file in source_files))
+
+    import aiohttp
+
+    # One session for all URLs so connections are pooled and reused
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*(
+            fetch_source_from_url(source_file, session) if is_url(source_file) else read_source_file(source_file)
+            for source_file in source_files
+        ))
+
+
+def positive_int(value: str) -> int:
+    """Parse a command-line value that must be an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def main() -> None:
     setup_logging('INFO')  # Default log level
     
     parser = argparse.ArgumentParser(
         description='Generate pseudocode from source code using LLM'
     )
-    parser.add_argument('source_files', type=str, nargs='+',
+    parser.add_argument('source_files', type=str, nargs='*',
                         help='Path to the source code file(s) or URL(s)')
     parser.add_argument('--output', '-o', type=str,
                         help='Output file path (optional, defaults to stdout)')
@@ -272,6 +1040,23 @@ def main() -> None:
                         help='Level of abstraction for pseudocode: 0 (summary) to 3 (detailed)')
     parser.add_argument('--loglevel', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], default='INFO',
                         help='Set the logging level')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Bypass the on-disk response cache (location set by PSEUDOGEN_CACHE)')
+    parser.add_argument('--cache-ttl', type=int, metavar='SECONDS',
+                        help='Ignore cached responses older than SECONDS')
+    parser.add_argument('--semantic-cache', action='store_true',
+                        help='Reuse cached responses for near-duplicate code using embeddings (requires numpy and faiss)')
+    parser.add_argument('--semantic-threshold', type=float, default=DEFAULT_SEMANTIC_THRESHOLD,
+                        help='Cosine similarity above which a cached response is reused')
+    parser.add_argument('--concurrency', type=positive_int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of concurrent API requests')
+    parser.add_argument('--batch-size', type=positive_int, default=1,
+                        help='Maximum number of chunks to combine into a single API request')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help='Sampling seed for reproducible output; OpenAI treats it as best-effort, '
+                             'so identical requests are usually but not always identical')
+    parser.add_argument('--skip-trivial', action='store_true',
+                        help='Do not send empty, import-only or very short sources to the model')
     args = parser.parse_args()
 
     if args.loglevel:
@@ -287,36 +1072,59 @@ def main() -> None:
     # Get API key from environment variable
     api_key = os.getenv('OPENAI_API_KEY')
     if not api_key:
-        logging.error("OpenAI API key not found. Please set it in .env file.")
+        logger.error("OpenAI API key not found. Please set it in .env file.")
         sys.exit(1)
     
-    all_pseudocodes = []
-    
-    for source_file in args.source_files:
-        # Determine if the source_file is a URL or a local file path
-        if source_file.startswith('http://') or source_file.startswith('https://'):
-            source_code = fetch_source_from_url(source_file)
-        else:
-            source_code = read_source_file(source_file)
-        
-        # Generate pseudocode
-        pseudocode = generate_pseudocode(source_code, api_key, args.model, args.abstractlevel)
-        all_pseudocodes.append(pseudocode)
-    
-    # Combine all pseudocodes
-    final_pseudocode = "\n\n".join(all_pseudocodes)
-    
-    # Output results
+    validate_model(args.model)
+
+    if args.semantic_cache:
+        try:
+            import faiss  # noqa: F401
+            import numpy  # noqa: F401
+        except ImportError as e:
+            logger.error("--semantic-cache requires numpy and faiss (pip install -r requirements-semantic.txt): %s", e)
+            sys.exit(1)
+
+    source_codes = asyncio.run(load_sources(args.source_files))
+
+    # With -o, open the file up front so results are written as soon as they are ready.
+    # Log records go to stdout, so stdout output is held until generation has finished.
+    output = None
     if args.output:
         try:
-            with open(args.output, 'w', encoding='utf-8') as f:
-                f.write(final_pseudocode)
-            logging.info(f"Pseudocode written to {args.output}")
+            output = open(args.output, 'wb')
         except Exception as e:
-            logging.error(f"Error writing to output file: {e}")
+            logger.error("Error writing to output file: %s", e)
             sys.exit(1)
+
+    def emit(text: str) -> None:
+        output.write(text.encode('utf-8'))
+        output.flush()
+
+    # Generate pseudocode for all sources concurrently
+    try:
+        all_pseudocodes, failed = asyncio.run(generate_all(
+            source_codes, api_key, args.model, args.abstractlevel, args.concurrency, args.batch_size,
+            use_cache=not args.no_cache, cache_ttl=args.cache_ttl,
+            semantic_threshold=args.semantic_threshold if args.semantic_cache else None, seed=args.seed,
+            emit=emit if output else None, skip_trivial=args.skip_trivial
+        ))
+    except OSError as e:
+        logger.error("Error writing output: %s", e)
+        sys.exit(1)
+
+    if output:
+        output.close()
+        logger.info("Pseudocode written to %s", args.output)
     else:
-        print(final_pseudocode)
+        # Write encoded bytes directly; flush the text layer first so log lines stay ordered
+        sys.stdout.flush()
+        sys.stdout.buffer.write(("\n\n".join(all_pseudocodes) + "\n").encode('utf-8'))
+        sys.stdout.buffer.flush()
+
+    # Partial output has been written, but callers must still see that the run failed
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
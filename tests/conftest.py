@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# pseudogen.py is a standalone script at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pseudogen  # noqa: E402
+
+
+class CharEncoding:
+    """One token per character, so tests do not need tiktoken's BPE files."""
+
+    def encode(self, text):
+        return [ord(c) for c in text]
+
+    def decode(self, tokens):
+        return "".join(chr(t) for t in tokens)
+
+    def decode_batch(self, batch):
+        return [self.decode(tokens) for tokens in batch]
+
+
+@pytest.fixture
+def char_encoding(monkeypatch):
+    monkeypatch.setattr(pseudogen, "_encoding", lambda model: CharEncoding())
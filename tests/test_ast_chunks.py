@@ -0,0 +1,46 @@
+import ast
+
+import pytest
+
+import pseudogen
+
+
+pytestmark = pytest.mark.usefixtures("char_encoding")
+
+
+@pytest.mark.parametrize("separator", ["\x0c", "\u2028", "\x85", "\x1c"])
+def test_chunks_keep_statements_intact(separator):
+    source = (
+        "import os\n"
+        "\x0c\n"
+        f"# section{separator}break\n"
+        "def a():\n"
+        "    return 1\n"
+        "\n"
+        "def b():\n"
+        f"    s = 'x{separator}y'\n"
+        "    return 2\n"
+        "\n"
+        "@decorator\n"
+        "class C:\n"
+        "    pass\n"
+    )
+    chunks = pseudogen.ast_chunks(source, budget=40)
+
+    assert len(chunks) > 1
+    assert sum(len(chunk) for chunk in chunks) == len(source)
+    for node in ast.parse(source).body:
+        segment = ast.get_source_segment(source, node)
+        assert any(segment in chunk for chunk in chunks), segment
+
+
+def test_chunks_handle_crlf_and_cr_line_endings():
+    source = "def a():\r\n    return 1\r\n\r\ndef b():\r    return 2\r"
+    chunks = pseudogen.ast_chunks(source, budget=30)
+
+    assert "".join(chunks) == source
+    assert chunks == ["def a():\r\n    return 1\r\n\r\n", "def b():\r    return 2\r"]
+
+
+def test_non_python_source_returns_none():
+    assert pseudogen.ast_chunks("def broken(:\n", budget=40) is None
@@ -0,0 +1,75 @@
+import asyncio
+import re
+
+import pytest
+
+import pseudogen
+
+
+pytestmark = pytest.mark.usefixtures("char_encoding")
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(pseudogen, "_cache_path", tmp_path)
+
+
+def test_parse_batch_response_splits_on_sentinels():
+    content = "Sure, here you go.\n=== BLOCK 1 ===\nfirst\n\n=== BLOCK 2 ===  \nsecond\nline\n"
+    assert pseudogen.parse_batch_response(content, 2) == ["first", "second\nline"]
+
+
+@pytest.mark.parametrize("content", [
+    "=== BLOCK 1 ===\nfirst\n",  # Missing block
+    "=== BLOCK 2 ===\nsecond\n=== BLOCK 1 ===\nfirst\n",  # Out of order
+    "=== BLOCK 1 ===\nfirst\n=== BLOCK 1 ===\nagain\n",  # Repeated
+    "first and second, no sentinels",
+    "",  # Truncated response
+])
+def test_parse_batch_response_rejects_malformed(content):
+    assert pseudogen.parse_batch_response(content, 2) is None
+
+
+def test_pack_chunks_respects_count_and_budget():
+    chunks = ["a" * 10, "b" * 10, "c" * 10, "d" * 30, "e" * 5]
+    # Each chunk costs its length plus 2 label tokens; one over budget still gets a batch of its own
+    assert pseudogen.pack_chunks(chunks, "gpt-4", 2, 30, 2) == [[0, 1], [2], [3], [4]]
+    assert pseudogen.pack_chunks(chunks, "gpt-4", 5, 40, 2) == [[0, 1, 2], [3, 4]]
+
+
+def batched_completion(requests, malformed=False, truncated=False):
+    async def request_completion(client, model, system_message, user_message, seed=None):
+        blocks = re.findall(r"^Block (\d+):\n(\w+)", user_message, re.MULTILINE)
+        requests.append(len(blocks))
+        if not blocks:
+            return "single " + user_message.split()[-1]
+        if truncated:
+            raise pseudogen.TruncatedResponseError("cut off")
+        if malformed:
+            return "I could not follow the format."
+        return "\n".join(f"=== BLOCK {n} ===\nbatched {code}" for n, code in blocks)
+    return request_completion
+
+
+def run_batch(chunks, **options):
+    return asyncio.run(pseudogen.process_batch(None, asyncio.Semaphore(1), chunks, "gpt-4", 1, **options))
+
+
+def test_process_batch_caches_each_block(monkeypatch):
+    requests = []
+    monkeypatch.setattr(pseudogen, "request_completion", batched_completion(requests))
+
+    assert run_batch(["alpha", "beta"]) == ["batched alpha", "batched beta"]
+    assert requests == [2]
+    # A later unbatched run hits the per-chunk entries
+    key = pseudogen.cache_key("gpt-4", 1, *pseudogen.build_messages("beta", 1), pseudogen.DEFAULT_SEED)
+    assert pseudogen.cache_get(key) == "batched beta"
+
+
+@pytest.mark.parametrize("failure", ["malformed", "truncated"])
+def test_process_batch_falls_back_to_single_requests(monkeypatch, failure):
+    requests = []
+    monkeypatch.setattr(pseudogen, "request_completion", batched_completion(requests, **{failure: True}))
+
+    assert run_batch(["alpha", "beta"]) == ["single alpha", "single beta"]
+    assert requests == [2, 0, 0]
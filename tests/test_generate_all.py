@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import pseudogen
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(pseudogen, "_cache_path", tmp_path)
+
+
+class FakeClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+def fail(*args, **kwargs):
+    raise AssertionError("a fully cached run must not tokenize or connect")
+
+
+def test_fully_cached_run_skips_tokenizer_and_api(monkeypatch):
+    sources = ["def a():\n    return 1\n", "print('b')\n"]
+    for n, source in enumerate(sources):
+        key = pseudogen.source_cache_key(source, "gpt-4", 1, pseudogen.DEFAULT_SEED)
+        pseudogen.cache_put(key, f"PSEUDO {n}")
+    for name in ("_encoding", "create_client"):
+        monkeypatch.setattr(pseudogen, name, fail)
+
+    pseudocodes, failed = asyncio.run(pseudogen.generate_all(sources, "key", "gpt-4"))
+
+    assert pseudocodes == ["PSEUDO 0", "PSEUDO 1"]
+    assert failed == 0
+
+
+def test_truncated_response_is_split_and_retried(monkeypatch, char_encoding):
+    source = "".join(f"def f{n}(x):\n    return x * {n}\n\n" for n in range(20))
+
+    async def request_completion(client, model, system_message, user_message, seed=None):
+        if len(user_message) > len(source):
+            raise pseudogen.TruncatedResponseError("cut off")
+        return f"PSEUDO {user_message.count('def ')}"
+
+    monkeypatch.setattr(pseudogen, "request_completion", request_completion)
+    monkeypatch.setattr(pseudogen, "create_client", FakeClient)
+
+    pseudocodes, failed = asyncio.run(pseudogen.generate_all([source], "key", "gpt-4"))
+
+    assert failed == 0
+    pieces = pseudocodes[0].split("\n\n")
+    assert len(pieces) > 1
+    assert sum(int(piece.split()[1]) for piece in pieces) == 20
+    assert pseudogen.cache_get(pseudogen.source_cache_key(source, "gpt-4", 1, pseudogen.DEFAULT_SEED)) == pseudocodes[0]
+
+
+def test_failed_chunks_are_numbered_within_their_source(monkeypatch, char_encoding):
+    sources = ["print('first')\n", "x = 1\n\ny = 2\n"]
+
+    async def request_completion(client, model, system_message, user_message, seed=None):
+        if "y = 2" in user_message:
+            raise ConnectionError("dropped")
+        return "PSEUDO"
+
+    monkeypatch.setattr(pseudogen, "request_completion", request_completion)
+    monkeypatch.setattr(pseudogen, "retryable_errors", lambda: (ConnectionError,))
+    monkeypatch.setattr(pseudogen, "create_client", FakeClient)
+    monkeypatch.setattr(pseudogen, "chunk_source", lambda source, model, budget: source.split("\n\n"))
+
+    pseudocodes, failed = asyncio.run(pseudogen.generate_all(sources, "key", "gpt-4"))
+
+    assert failed == 1
+    assert pseudocodes == ["PSEUDO", "PSEUDO\n\n[[CHUNK 2 FAILED]]"]